@@ -6,14 +6,22 @@ Colors can be toggled per user
 """
 
 import asyncio
+import re
 import sqlite3
-import datetime
+import time
 from typing import Dict, Optional
 
+try:
+    import uvloop  # optional, faster event loop
+except ImportError:
+    uvloop = None
+
 # ==================== CONFIG ====================
 HOST = '0.0.0.0'
 PORT = 6667
 DB_PATH = "simple_chat.db"
+FLUSH_BATCH = 256       # max messages written per transaction
+FLUSH_DELAY = 0.05      # seconds to let a burst pile up before writing
 
 MOTD = [
     "==============================",
@@ -22,6 +30,8 @@ MOTD = [
     "  /color on/off → toggle ansi",
     "=============================="
 ]
+# identical for every connection, so encode it once
+_MOTD_TAIL = b"".join(f":{line}\r\n".encode() for line in MOTD)
 
 # ANSI colors
 COLORS = {
@@ -35,9 +45,49 @@ COLORS = {
     "white": "\033[97m",
 }
 
+# single-pass coloring: every special char maps to its colored form
+_COLOR_RE = re.compile(r'[<>\[\]→←]')
+_COLOR_TABLE = {
+    "<": f"{COLORS['green']}<",
+    ">": f">{COLORS['reset']}",
+    "[": f"{COLORS['yellow']}[",
+    "]": f"]{COLORS['reset']}",
+    "→": f"{COLORS['cyan']}→{COLORS['reset']}",
+    "←": f"{COLORS['purple']}←{COLORS['reset']}",
+}
+
 # ==================== DATABASE ====================
+# fixed SQL text, so each statement is compiled once per connection and then
+# served from the sqlite3 statement cache
+SQL_INSERT = "INSERT INTO messages (from_nick, to_nick, message) VALUES (?,?,?)"
+SQL_DM_HISTORY = """
+    SELECT from_nick, to_nick, message, timestamp
+    FROM messages
+    WHERE from_nick = ? OR to_nick = ?
+    ORDER BY id DESC LIMIT ?
+"""
+SQL_PUBLIC_HISTORY = """
+    SELECT from_nick, message, timestamp
+    FROM messages
+    WHERE to_nick IS NULL
+    ORDER BY id DESC LIMIT ?
+"""
+
+def connect_db() -> sqlite3.Connection:
+    # autocommit; write transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")        # 64 MiB
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")      # 256 MiB
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
+    # WAL is persistent in the db file, so readers never wait on the writer
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS messages (
@@ -48,7 +98,10 @@ def init_db():
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
+    # /history dm filters on either nick; idx_msgs_to also serves public history
+    # (to_nick IS NULL ORDER BY id DESC)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msgs_from ON messages(from_nick, id DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msgs_to ON messages(to_nick, id DESC)")
     conn.close()
 
 # ==================== STATE ====================
@@ -56,57 +109,140 @@ class User:
     def __init__(self, writer: asyncio.StreamWriter, nick: str = "Guest"):
         self.writer = writer
         self.nick = nick
+        self.nick_lower = nick.lower()  # key into ChatServer.users
         self.colors_enabled = False
+        # concurrent drain() calls on one writer can trip asyncio, so serialize them
+        self.write_lock = asyncio.Lock()
 
 class ChatServer:
     def __init__(self):
         self.users: Dict[str, User] = {}  # lower_nick → User
+        # one long-lived connection for writes, a second one for history reads;
+        # opened in start() so importing the module doesn't touch DB_PATH
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_read: Optional[sqlite3.Connection] = None
+        self.db_lock = asyncio.Lock()
+        self.db_read_lock = asyncio.Lock()
+        # messages waiting to be written: (from_nick, to_nick, message)
+        self.pending: asyncio.Queue = asyncio.Queue()
+        self._wake = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start(self):
+        # call after init_db(), so the connections see WAL and the schema
+        self.db = connect_db()
+        self.db_read = connect_db()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    # sqlite calls block, so they run on a worker thread to keep the loop free
+    def _insert_many(self, rows: list):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany(SQL_INSERT, rows)
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            # a failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction open
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            raise
+
+    def _select(self, sql: str, params: tuple) -> list:
+        return self.db_read.execute(sql, params).fetchall()
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        # closing the last connection checkpoints the WAL back into the db file
+        for conn in (self.db_read, self.db):
+            if conn is not None:
+                conn.close()
+        self.db = self.db_read = None
+
+    async def store(self, from_nick: str, to_nick: Optional[str], message: str):
+        self.pending.put_nowait((from_nick, to_nick, message))
+        self._wake.set()
+
+    async def _write(self, batch: list):
+        try:
+            await asyncio.to_thread(self._insert_many, batch)
+        except sqlite3.Error as e:
+            print(f"DB error, dropped {len(batch)} messages: {e}")
+
+    async def flush(self):
+        async with self.db_lock:
+            while not self.pending.empty():
+                batch = []
+                while len(batch) < FLUSH_BATCH and not self.pending.empty():
+                    batch.append(self.pending.get_nowait())
+                # once rows leave the queue, let the write finish even if we
+                # get cancelled, so they are neither lost nor written twice
+                write = asyncio.create_task(self._write(batch))
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    await write
+                    raise
+
+    async def _flush_loop(self):
+        # rows stay queued until flush() takes them, so cancelling this is safe
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(FLUSH_DELAY)
+            self._wake.clear()
+            await self.flush()
+
+    async def fetch(self, sql: str, params: tuple) -> list:
+        async with self.db_read_lock:
+            return await asyncio.to_thread(self._select, sql, params)
 
     async def broadcast(self, message: str, skip_nick: Optional[str] = None):
-        for nick_lower, user in list(self.users.items()):
-            if skip_nick and nick_lower == skip_nick.lower():
+        skip = skip_nick.lower() if skip_nick else None
+        # only two renderings exist (plain / colored), encode each at most once
+        plain = f"{message}\r\n".encode()
+        colored = None
+        sends = []
+        # nothing is awaited while iterating, so users can't change under us
+        for user in self.users.values():
+            if user.nick_lower == skip:
                 continue
-            try:
-                colored = self.apply_color(user, message)
-                user.writer.write(f"{colored}\r\n".encode())
-                await user.writer.drain()
-            except:
-                pass
+            data = colored if user.colors_enabled else plain
+            if data is None:
+                colored = data = f"{self.apply_color(user, message)}\r\n".encode()
+            sends.append(send_bytes(user, data))
+        # drain every recipient concurrently instead of one after another
+        await asyncio.gather(*sends)
 
-    async def send_to(self, nick: str, message: str):
-        nick_lower = nick.lower()
-        if nick_lower in self.users:
-            try:
-                user = self.users[nick_lower]
-                colored = self.apply_color(user, message)
-                user.writer.write(f"{colored}\r\n".encode())
-                await user.writer.drain()
-            except:
-                pass
+    async def send_to(self, user: User, message: str):
+        await send_bytes(user, f"{self.apply_color(user, message)}\r\n".encode())
 
     def apply_color(self, user: User, text: str) -> str:
         if not user.colors_enabled:
             return text
         # Very simple coloring
-        return text.replace("<", f"{COLORS['green']}<").replace(">", f">{COLORS['reset']}") \
-                   .replace("[", f"{COLORS['yellow']}[") .replace("]", f"]{COLORS['reset']}") \
-                   .replace("→", f"{COLORS['cyan']}→{COLORS['reset']}") \
-                   .replace("←", f"{COLORS['purple']}←{COLORS['reset']}")
+        return _COLOR_RE.sub(lambda m: _COLOR_TABLE[m.group(0)], text)
 
 chat_server = ChatServer()
 
 
 # ==================== COMMANDS ====================
-async def handle_command(user: User, line: str):
-    parts = line.strip().split(maxsplit=1)
-    cmd = parts[0].lower()[1:] if parts[0].startswith("/") else ""
-    args = parts[1] if len(parts) > 1 else ""
+_CMD_RE = re.compile(r'^/(\w+)(?:\s+(.*))?$')
+_NICK_RE = re.compile(r'^[A-Za-z0-9_-]{1,24}$')
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+async def handle_command(user: User, line: str):
+    m = _CMD_RE.match(line)
+    if not m:
+        return
+    cmd = m.group(1).lower()
+    args = m.group(2) or ""
 
     if cmd == "help":
-        await send_lines(user.writer, [
+        await send_lines(user, [
             "/nick <name>          → change nickname",
             "/msg <nick> <text>    → send private message",
             "/dm <nick> <text>     → same as /msg",
@@ -117,46 +253,46 @@ async def handle_command(user: User, line: str):
 
     elif cmd == "nick":
         if not args:
-            await send_msg(user.writer, "Usage: /nick NewName")
+            await send_msg(user, "Usage: /nick NewName")
             return
         newnick = args.split()[0][:24]
-        if not newnick.isalnum() and "_" not in newnick and "-" not in newnick:
-            await send_msg(user.writer, "Nick can contain letters, numbers, _, -")
+        if not _NICK_RE.match(newnick):
+            await send_msg(user, "Nick can contain letters, numbers, _, -")
             return
         new_lower = newnick.lower()
-        if new_lower in chat_server.users and new_lower != user.nick.lower():
-            await send_msg(user.writer, "Nickname already in use")
+        if new_lower in chat_server.users and new_lower != user.nick_lower:
+            await send_msg(user, "Nickname already in use")
             return
 
         old = user.nick
-        chat_server.users.pop(user.nick.lower(), None)
+        chat_server.users.pop(user.nick_lower, None)
         user.nick = newnick
+        user.nick_lower = new_lower
         chat_server.users[new_lower] = user
 
         await chat_server.broadcast(f"* {old} is now known as {newnick}")
-        await send_msg(user.writer, f"You are now {newnick}")
+        await send_msg(user, f"You are now {newnick}")
 
     elif cmd in ("msg", "dm"):
         if not args or " " not in args:
-            await send_msg(user.writer, "Usage: /msg nickname message here")
+            await send_msg(user, "Usage: /msg nickname message here")
             return
         target, msg = args.split(" ", 1)
         target_lower = target.lower()
 
-        if target_lower == user.nick.lower():
-            await send_msg(user.writer, "Can't message yourself")
+        if target_lower == user.nick_lower:
+            await send_msg(user, "Can't message yourself")
             return
-        if target_lower not in chat_server.users:
-            await send_msg(user.writer, f"{target} is not online")
+        target_user = chat_server.users.get(target_lower)
+        if target_user is None:
+            await send_msg(user, f"{target} is not online")
             return
 
-        ts = datetime.datetime.now().strftime("%H:%M")
-        await send_msg(user.writer,    f"[{ts}] → {target} {msg}")
-        await chat_server.send_to(target, f"[{ts}] ← {user.nick} {msg}")
+        ts = now_hm()
+        await send_msg(user,    f"[{ts}] → {target} {msg}")
+        await chat_server.send_to(target_user, f"[{ts}] ← {user.nick} {msg}")
 
-        c.execute("INSERT INTO messages (from_nick, to_nick, message) VALUES (?,?,?)",
-                  (user.nick, target, msg))
-        conn.commit()
+        await chat_server.store(user.nick, target, msg)
 
     elif cmd == "history":
         try:
@@ -164,112 +300,137 @@ async def handle_command(user: User, line: str):
         except:
             limit = 10
 
+        # write out anything still queued so you always see your own messages
+        await chat_server.flush()
+
         if " " in args and args.split()[1].lower() == "dm":
             # last DMs involving me
-            c.execute("""
-                SELECT from_nick, to_nick, message, timestamp
-                FROM messages
-                WHERE from_nick = ? OR to_nick = ?
-                ORDER BY id DESC LIMIT ?
-            """, (user.nick, user.nick, limit))
-            rows = c.fetchall()[::-1]
-            await send_msg(user.writer, f"Recent private messages ({len(rows)}):")
+            rows = await chat_server.fetch(SQL_DM_HISTORY, (user.nick, user.nick, limit))
+            rows.reverse()
+            lines = [f"Recent private messages ({len(rows)}):"]
             for fr, to, msg, ts in rows:
                 t = ts[11:16]
                 arrow = "→" if fr == user.nick else "←"
                 who = to if fr == user.nick else fr
-                await send_msg(user.writer, f"[{t}] {arrow} {who} {msg}")
+                lines.append(f"[{t}] {arrow} {who} {msg}")
+            await send_lines(user, lines)
         else:
             # public chat
-            c.execute("""
-                SELECT from_nick, message, timestamp
-                FROM messages
-                WHERE to_nick IS NULL
-                ORDER BY id DESC LIMIT ?
-            """, (limit,))
-            rows = c.fetchall()[::-1]
-            await send_msg(user.writer, f"Recent public messages ({len(rows)}):")
+            rows = await chat_server.fetch(SQL_PUBLIC_HISTORY, (limit,))
+            rows.reverse()
+            lines = [f"Recent public messages ({len(rows)}):"]
             for nick, msg, ts in rows:
                 t = ts[11:16]
-                await send_msg(user.writer, f"[{t}] <{nick}> {msg}")
+                lines.append(f"[{t}] <{nick}> {msg}")
+            await send_lines(user, lines)
 
     elif cmd == "color":
         if args.lower() == "on":
             user.colors_enabled = True
-            await send_msg(user.writer, "Colored output → enabled")
+            await send_msg(user, "Colored output → enabled")
         elif args.lower() == "off":
             user.colors_enabled = False
-            await send_msg(user.writer, "Colored output → disabled")
+            await send_msg(user, "Colored output → disabled")
         else:
-            await send_msg(user.writer, f"Current: {'on' if user.colors_enabled else 'off'}   Usage: /color on|off")
-
-    conn.close()
+            await send_msg(user, f"Current: {'on' if user.colors_enabled else 'off'}   Usage: /color on|off")
 
 
 # ==================== HELPERS ====================
-async def send_msg(writer, text: str):
+# "HH:MM" only changes once a minute: [text, time the current minute ends]
+_ts_cache = ["", 0.0]
+
+def now_hm() -> str:
+    t = time.time()
+    if t >= _ts_cache[1]:
+        _ts_cache[0] = time.strftime("%H:%M", time.localtime(t))
+        _ts_cache[1] = t - t % 60 + 60
+    return _ts_cache[0]
+
+async def send_bytes(user: User, data: bytes):
+    # cheap check for the usual "already gone" case, no exception needed
+    if user.writer.is_closing():
+        return
     try:
-        writer.write(f":{text}\r\n".encode())
-        await writer.drain()
-    except:
+        async with user.write_lock:
+            user.writer.write(data)
+            await user.writer.drain()
+    except OSError:  # ConnectionResetError, BrokenPipeError, ...
         pass
 
-async def send_lines(writer, lines):
-    for line in lines:
-        await send_msg(writer, line)
+async def send_msg(user: User, text: str):
+    await send_bytes(user, f":{text}\r\n".encode())
+
+async def send_lines(user: User, lines):
+    # one write + one drain for the whole block
+    await send_bytes(user, b"".join(f":{line}\r\n".encode() for line in lines))
+
+async def read_line(reader: asyncio.StreamReader) -> Optional[bytes]:
+    # b"" at EOF, None if the line was longer than the StreamReader limit
+    overlong = False
+    while True:
+        try:
+            line_bytes = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return None if overlong else e.partial
+        except asyncio.LimitOverrunError as e:
+            # drop what is buffered, then keep dropping until the line's "\n"
+            # so the tail of an over-long line never reaches dispatch()
+            await reader.readexactly(e.consumed)
+            overlong = True
+            continue
+        return None if overlong else line_bytes
 
 
 # ==================== CLIENT HANDLER ====================
+async def dispatch(user: User, line: str):
+    if line.startswith("/"):
+        await handle_command(user, line)
+        return
+
+    # Normal message → public chat
+    if len(line) > 400:
+        await send_msg(user, "Message too long (max ~400 chars)")
+        return
+
+    ts = now_hm()
+    msg_line = f"[{ts}] <{user.nick}> {line}"
+
+    await chat_server.broadcast(msg_line, skip_nick=user.nick)
+    await chat_server.store(user.nick, None, line)
+
+
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # let drain() wait for the kernel instead of queueing output in user space
+    writer.transport.set_write_buffer_limits(high=0)
     user = User(writer)
-    chat_server.users[user.nick.lower()] = user
+    chat_server.users[user.nick_lower] = user
 
     addr = writer.get_extra_info('peername')
     print(f"Connected: {addr} → {user.nick}")
 
-    await send_lines(writer, [f":server 001 {user.nick} :Welcome!"] + MOTD)
+    await send_bytes(user, f":server 001 {user.nick} :Welcome!\r\n".encode() + _MOTD_TAIL)
 
     # Welcome message in chat
     await chat_server.broadcast(f"* {user.nick} has joined the chat")
 
     try:
-        while True:
-            data = await reader.read(1024)
-            if not data:
+        while not reader.at_eof():
+            # StreamReader does the framing, so lines split across reads stay whole
+            line_bytes = await read_line(reader)
+            if line_bytes is None:
+                await send_msg(user, "Message too long (max ~400 chars)")
+                continue
+            if not line_bytes:
                 break
-
-            for line in data.decode(errors='ignore').splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-
-                if line.startswith("/"):
-                    await handle_command(user, line)
-                    continue
-
-                # Normal message → public chat
-                if len(line) > 400:
-                    await send_msg(writer, "Message too long (max ~400 chars)")
-                    continue
-
-                ts = datetime.datetime.now().strftime("%H:%M")
-                msg_line = f"[{ts}] <{user.nick}> {line}"
-
-                await chat_server.broadcast(msg_line, skip_nick=user.nick)
-
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("INSERT INTO messages (from_nick, message) VALUES (?,?)",
-                          (user.nick, line))
-                conn.commit()
-                conn.close()
+            line = line_bytes.decode('utf-8', 'ignore').strip()
+            if line:
+                await dispatch(user, line)
 
     except Exception as e:
         print(f"Error {addr}: {e}")
     finally:
-        nick_lower = user.nick.lower()
-        if nick_lower in chat_server.users:
-            del chat_server.users[nick_lower]
+        if user.nick_lower in chat_server.users:
+            del chat_server.users[user.nick_lower]
         await chat_server.broadcast(f"* {user.nick} has left")
         writer.close()
         await writer.wait_closed()
@@ -279,15 +440,21 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
 # ==================== MAIN ====================
 async def main():
     init_db()
+    chat_server.start()
     server = await asyncio.start_server(handle_client, HOST, PORT)
     addr = server.sockets[0].getsockname()
     print(f"Simple chat running → {addr}")
 
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await chat_server.stop()
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
@@ -4,15 +4,23 @@ Very simple chat server + crude /ssh @nick feature using netcat
 """
 
 import asyncio
+import re
 import sqlite3
-import datetime
+import time
 import secrets
 import socket
 from typing import Dict, Optional
 
+try:
+    import uvloop  # optional, faster event loop
+except ImportError:
+    uvloop = None
+
 HOST = '127.0.0.1'
 PORT = 6667
 DB_PATH = "simple_chat.db"
+FLUSH_BATCH = 256       # max messages written per transaction
+FLUSH_DELAY = 0.05      # seconds to let a burst pile up before writing
 
 MOTD = [
     "==============================",
@@ -22,56 +30,167 @@ MOTD = [
     "  /ssh @nick     → crude rsh ",
     "=============================="
 ]
+# identical for every connection, so encode it once
+_MOTD_TAIL = b"".join(f":{line}\r\n".encode() for line in MOTD)
+
+_COLOR_RE = re.compile(r'[<>\[\]→←]')
+_COLOR_TABLE = {
+    "<": "\033[32m<",
+    ">": ">\033[0m",
+    "[": "\033[33m[",
+    "]": "]\033[0m",
+    "→": "\033[36m→\033[0m",
+    "←": "\033[35m←\033[0m",
+}
+
+# fixed SQL text so the sqlite3 statement cache reuses the compiled statements
+SQL_INSERT = "INSERT INTO messages (from_nick, to_nick, message) VALUES (?,?,?)"
+SQL_DM_HISTORY = """
+    SELECT from_nick, to_nick, message, ts
+    FROM messages WHERE from_nick = ? OR to_nick = ?
+    ORDER BY id DESC LIMIT ?
+"""
+SQL_PUBLIC_HISTORY = "SELECT from_nick, message, ts FROM messages WHERE to_nick IS NULL ORDER BY id DESC LIMIT ?"
+
+def connect_db() -> sqlite3.Connection:
+    # autocommit; write transactions are opened explicitly with BEGIN IMMEDIATE
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None,
+                           cached_statements=256)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-65536")        # 64 MiB
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")      # 256 MiB
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
 
 class User:
     def __init__(self, writer: asyncio.StreamWriter, nick: str = "Guest"):
         self.writer = writer
         self.nick = nick
+        self.nick_lower = nick.lower()  # key into ChatServer.users
         self.colors_enabled = False
+        # concurrent drain() calls on one writer can trip asyncio, so serialize them
+        self.write_lock = asyncio.Lock()
 
 class ChatServer:
     def __init__(self):
         self.users: Dict[str, User] = {}  # lower_nick → User
+        # one long-lived connection for writes, a second one for history reads;
+        # opened in start() so importing the module doesn't touch DB_PATH
+        self.db: Optional[sqlite3.Connection] = None
+        self.db_read: Optional[sqlite3.Connection] = None
+        self.db_lock = asyncio.Lock()
+        self.db_read_lock = asyncio.Lock()
+        # messages waiting to be written: (from_nick, to_nick, message)
+        self.pending: asyncio.Queue = asyncio.Queue()
+        self._wake = asyncio.Event()
+        self._flusher: Optional[asyncio.Task] = None
+
+    def start(self):
+        # call after init_db(), so the connections see WAL and the schema
+        self.db = connect_db()
+        self.db_read = connect_db()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    # sqlite calls block, so they run on a worker thread to keep the loop free
+    def _insert_many(self, rows: list):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.executemany(SQL_INSERT, rows)
+            self.db.execute("COMMIT")
+        except sqlite3.Error:
+            # a failed COMMIT (e.g. SQLITE_BUSY) leaves the transaction open
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            raise
+
+    def _select(self, sql: str, params: tuple) -> list:
+        return self.db_read.execute(sql, params).fetchall()
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        # closing the last connection checkpoints the WAL back into the db file
+        for conn in (self.db_read, self.db):
+            if conn is not None:
+                conn.close()
+        self.db = self.db_read = None
+
+    async def store(self, from_nick: str, to_nick: Optional[str], message: str):
+        self.pending.put_nowait((from_nick, to_nick, message))
+        self._wake.set()
+
+    async def _write(self, batch: list):
+        try:
+            await asyncio.to_thread(self._insert_many, batch)
+        except sqlite3.Error as e:
+            print(f"DB error, dropped {len(batch)} messages: {e}")
+
+    async def flush(self):
+        async with self.db_lock:
+            while not self.pending.empty():
+                batch = []
+                while len(batch) < FLUSH_BATCH and not self.pending.empty():
+                    batch.append(self.pending.get_nowait())
+                # once rows leave the queue, let the write finish even if we
+                # get cancelled, so they are neither lost nor written twice
+                write = asyncio.create_task(self._write(batch))
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    await write
+                    raise
+
+    async def _flush_loop(self):
+        # rows stay queued until flush() takes them, so cancelling this is safe
+        while True:
+            await self._wake.wait()
+            await asyncio.sleep(FLUSH_DELAY)
+            self._wake.clear()
+            await self.flush()
+
+    async def fetch(self, sql: str, params: tuple) -> list:
+        async with self.db_read_lock:
+            return await asyncio.to_thread(self._select, sql, params)
 
     async def broadcast(self, message: str, skip_nick: Optional[str] = None):
-        for nick_lower, u in list(self.users.items()):
-            if skip_nick and nick_lower == skip_nick.lower():
+        skip = skip_nick.lower() if skip_nick else None
+        # only two renderings exist (plain / colored), encode each at most once
+        plain = f"{message}\r\n".encode()
+        colored = None
+        sends = []
+        # nothing is awaited while iterating, so users can't change under us
+        for u in self.users.values():
+            if u.nick_lower == skip:
                 continue
-            try:
-                text = self._maybe_color(u, message)
-                u.writer.write(f"{text}\r\n".encode())
-                await u.writer.drain()
-            except:
-                pass
+            data = colored if u.colors_enabled else plain
+            if data is None:
+                colored = data = f"{self._maybe_color(u, message)}\r\n".encode()
+            sends.append(send_bytes(u, data))
+        # drain every recipient concurrently instead of one after another
+        await asyncio.gather(*sends)
 
-    async def send(self, nick: str, message: str):
-        nick_lower = nick.lower()
-        if nick_lower in self.users:
-            try:
-                u = self.users[nick_lower]
-                text = self._maybe_color(u, message)
-                u.writer.write(f"{text}\r\n".encode())
-                await u.writer.drain()
-            except:
-                pass
+    async def send(self, u: User, message: str):
+        await send_bytes(u, f"{self._maybe_color(u, message)}\r\n".encode())
 
     def _maybe_color(self, user: User, text: str) -> str:
         if not user.colors_enabled:
             return text
-        # Very naive coloring
-        return (
-            text.replace("<", "\033[32m<")
-                .replace(">", ">\033[0m")
-                .replace("[", "\033[33m[")
-                .replace("]", "]\033[0m")
-                .replace("→", "\033[36m→\033[0m")
-                .replace("←", "\033[35m←\033[0m")
-        )
+        # Very naive coloring, one pass over the text
+        return _COLOR_RE.sub(lambda m: _COLOR_TABLE[m.group(0)], text)
 
 chat_server = ChatServer()
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
+    # WAL is persistent in the db file, so readers never wait on the writer
+    conn.execute("PRAGMA journal_mode=WAL")
     c = conn.cursor()
     c.execute('''
         CREATE TABLE IF NOT EXISTS messages (
@@ -82,19 +201,23 @@ def init_db():
             ts DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    conn.commit()
+    # /history dm filters on either nick; idx_msgs_to also serves public history
+    # (to_nick IS NULL ORDER BY id DESC)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msgs_from ON messages(from_nick, id DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_msgs_to ON messages(to_nick, id DESC)")
     conn.close()
 
-async def handle_command(user: User, line: str):
-    parts = line.strip().split(maxsplit=1)
-    cmd = parts[0].lower()[1:] if parts[0].startswith("/") else ""
-    args = parts[1] if len(parts) > 1 else ""
+_CMD_RE = re.compile(r'^/(\w+)(?:\s+(.*))?$')
 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+async def handle_command(user: User, line: str):
+    m = _CMD_RE.match(line)
+    if not m:
+        return
+    cmd = m.group(1).lower()
+    args = m.group(2) or ""
 
     if cmd == "help":
-        await send_lines(user.writer, [
+        await send_lines(user, [
             "/nick <name>",
             "/msg <nick> <text>   or   /dm ...",
             "/history [n]          or   /history dm",
@@ -106,35 +229,35 @@ async def handle_command(user: User, line: str):
 
     elif cmd == "nick":
         if not args:
-            await send_msg(user.writer, "Usage: /nick NewName")
+            await send_msg(user, "Usage: /nick NewName")
             return
         newnick = args.split()[0][:24]
         new_lower = newnick.lower()
-        if new_lower in chat_server.users and new_lower != user.nick.lower():
-            await send_msg(user.writer, "Nick in use")
+        if new_lower in chat_server.users and new_lower != user.nick_lower:
+            await send_msg(user, "Nick in use")
             return
         old = user.nick
-        chat_server.users.pop(user.nick.lower(), None)
+        chat_server.users.pop(user.nick_lower, None)
         user.nick = newnick
+        user.nick_lower = new_lower
         chat_server.users[new_lower] = user
         await chat_server.broadcast(f"* {old} → {newnick}")
-        await send_msg(user.writer, f"Now known as {newnick}")
+        await send_msg(user, f"Now known as {newnick}")
 
     elif cmd in ("msg", "dm"):
         if " " not in args:
-            await send_msg(user.writer, "Usage: /msg nick message")
+            await send_msg(user, "Usage: /msg nick message")
             return
         target, msg = args.split(" ", 1)
         tlow = target.lower()
-        if tlow not in chat_server.users:
-            await send_msg(user.writer, f"{target} not online")
+        target_user = chat_server.users.get(tlow)
+        if target_user is None:
+            await send_msg(user, f"{target} not online")
             return
-        ts = datetime.datetime.now().strftime("%H:%M")
-        await send_msg(user.writer,    f"[{ts}] → {target} {msg}")
-        await chat_server.send(target, f"[{ts}] ← {user.nick} {msg}")
-        c.execute("INSERT INTO messages (from_nick, to_nick, message) VALUES (?,?,?)",
-                  (user.nick, target, msg))
-        conn.commit()
+        ts = now_hm()
+        await send_msg(user,    f"[{ts}] → {target} {msg}")
+        await chat_server.send(target_user, f"[{ts}] ← {user.nick} {msg}")
+        await chat_server.store(user.nick, target, msg)
 
     elif cmd == "history":
         limit = 10
@@ -147,70 +270,70 @@ async def handle_command(user: User, line: str):
             except:
                 pass
 
+        # write out anything still queued so you always see your own messages
+        await chat_server.flush()
+
         if "dm" in args.lower():
-            c.execute("""
-                SELECT from_nick, to_nick, message, ts
-                FROM messages WHERE from_nick = ? OR to_nick = ?
-                ORDER BY id DESC LIMIT ?
-            """, (user.nick, user.nick, limit))
-            rows = c.fetchall()[::-1]
-            await send_msg(user.writer, f"Recent DMs ({len(rows)}):")
+            rows = await chat_server.fetch(SQL_DM_HISTORY, (user.nick, user.nick, limit))
+            rows.reverse()
+            lines = [f"Recent DMs ({len(rows)}):"]
             for fr, to, m, ts in rows:
                 t = ts[11:16]
                 arr = "→" if fr == user.nick else "←"
                 who = to if fr == user.nick else fr
-                await send_msg(user.writer, f"[{t}] {arr} {who} {m}")
+                lines.append(f"[{t}] {arr} {who} {m}")
+            await send_lines(user, lines)
         else:
-            c.execute("SELECT from_nick, message, ts FROM messages WHERE to_nick IS NULL ORDER BY id DESC LIMIT ?", (limit,))
-            rows = c.fetchall()[::-1]
-            await send_msg(user.writer, f"Recent chat ({len(rows)}):")
+            rows = await chat_server.fetch(SQL_PUBLIC_HISTORY, (limit,))
+            rows.reverse()
+            lines = [f"Recent chat ({len(rows)}):"]
             for nick, m, ts in rows:
                 t = ts[11:16]
-                await send_msg(user.writer, f"[{t}] <{nick}> {m}")
+                lines.append(f"[{t}] <{nick}> {m}")
+            await send_lines(user, lines)
 
     elif cmd == "color":
         if args.lower() in ("on", "yes", "true"):
             user.colors_enabled = True
-            await send_msg(user.writer, "Colors → ON")
+            await send_msg(user, "Colors → ON")
         elif args.lower() in ("off", "no", "false"):
             user.colors_enabled = False
-            await send_msg(user.writer, "Colors → OFF")
+            await send_msg(user, "Colors → OFF")
         else:
-            await send_msg(user.writer, f"Colors currently {'ON' if user.colors_enabled else 'OFF'}")
+            await send_msg(user, f"Colors currently {'ON' if user.colors_enabled else 'OFF'}")
 
     elif cmd == "ssh":
         if not args.startswith("@"):
-            await send_msg(user.writer, "Usage: /ssh @nickname")
+            await send_msg(user, "Usage: /ssh @nickname")
             return
         target_nick = args[1:].split()[0].strip()
         tlow = target_nick.lower()
-        if tlow == user.nick.lower():
-            await send_msg(user.writer, "Cannot ssh yourself")
+        if tlow == user.nick_lower:
+            await send_msg(user, "Cannot ssh yourself")
             return
-        if tlow not in chat_server.users:
-            await send_msg(user.writer, f"@{target_nick} not online")
+        target = chat_server.users.get(tlow)
+        if target is None:
+            await send_msg(user, f"@{target_nick} not online")
             return
 
-        target = chat_server.users[tlow]
-
         # Pick random high port
         port = secrets.randbelow(10000) + 50000
 
-        await send_msg(target.writer,
+        await send_msg(target,
             f"!!! SHELL REQUEST from @{user.nick} !!!\n"
             f"Reply with   /sshyes {port}   to ACCEPT (dangerous!)\n"
             f"Ignore or close window to refuse."
         )
-        await send_msg(user.writer,
+        await send_msg(user,
             f"Shell request sent to @{target_nick} — waiting for /sshyes ...")
 
     elif cmd == "sshyes":
         if not args.isdigit():
-            await send_msg(user.writer, "Usage: /sshyes PORT   (only use the port you were given)")
+            await send_msg(user, "Usage: /sshyes PORT   (only use the port you were given)")
             return
         port = int(args)
         if not (50000 <= port <= 59999):
-            await send_msg(user.writer, "Port out of allowed range")
+            await send_msg(user, "Port out of allowed range")
             return
 
         # Try to guess our public IP (very unreliable on NAT)
@@ -230,7 +353,7 @@ async def handle_command(user: User, line: str):
             skip_nick=user.nick
         )
 
-        await send_msg(user.writer,
+        await send_msg(user,
             f"Run this in a NEW terminal to listen for shell:\n"
             f"   nc -l -p {port} -e /bin/sh     (Linux/macOS)\n"
             f"or\n"
@@ -238,62 +361,93 @@ async def handle_command(user: User, line: str):
             f"Waiting for connection..."
         )
 
-    conn.close()
+# "HH:MM" only changes once a minute: [text, time the current minute ends]
+_ts_cache = ["", 0.0]
+
+def now_hm() -> str:
+    t = time.time()
+    if t >= _ts_cache[1]:
+        _ts_cache[0] = time.strftime("%H:%M", time.localtime(t))
+        _ts_cache[1] = t - t % 60 + 60
+    return _ts_cache[0]
 
-async def send_msg(w, text: str):
+async def send_bytes(u: User, data: bytes):
+    # cheap check for the usual "already gone" case, no exception needed
+    if u.writer.is_closing():
+        return
     try:
-        w.write(f":{text}\r\n".encode())
-        await w.drain()
-    except:
+        async with u.write_lock:
+            u.writer.write(data)
+            await u.writer.drain()
+    except OSError:  # ConnectionResetError, BrokenPipeError, ...
         pass
 
-async def send_lines(w, lines):
-    for line in lines:
-        await send_msg(w, line)
+async def send_msg(u: User, text: str):
+    await send_bytes(u, f":{text}\r\n".encode())
+
+async def send_lines(u: User, lines):
+    # one write + one drain for the whole block
+    await send_bytes(u, b"".join(f":{line}\r\n".encode() for line in lines))
+
+async def read_line(reader: asyncio.StreamReader) -> Optional[bytes]:
+    # b"" at EOF, None if the line was longer than the StreamReader limit
+    overlong = False
+    while True:
+        try:
+            line_bytes = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError as e:
+            return None if overlong else e.partial
+        except asyncio.LimitOverrunError as e:
+            # drop what is buffered, then keep dropping until the line's "\n"
+            # so the tail of an over-long line never reaches dispatch()
+            await reader.readexactly(e.consumed)
+            overlong = True
+            continue
+        return None if overlong else line_bytes
+
+async def dispatch(user: User, line: str):
+    if line.startswith("/"):
+        await handle_command(user, line)
+        return
+    # public message
+    if len(line) > 400:
+        await send_msg(user, "Message too long")
+        return
+    ts = now_hm()
+    msg = f"[{ts}] <{user.nick}> {line}"
+    await chat_server.broadcast(msg, skip_nick=user.nick)
+    await chat_server.store(user.nick, None, line)
 
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # let drain() wait for the kernel instead of queueing output in user space
+    writer.transport.set_write_buffer_limits(high=0)
     user = User(writer)
-    chat_server.users[user.nick.lower()] = user
+    chat_server.users[user.nick_lower] = user
 
     addr = writer.get_extra_info('peername')
     print(f"Connected: {addr} → {user.nick}")
 
-    await send_lines(writer, [f":server 001 {user.nick} :Welcome!"] + MOTD)
+    await send_bytes(user, f":server 001 {user.nick} :Welcome!\r\n".encode() + _MOTD_TAIL)
     await chat_server.broadcast(f"* {user.nick} joined")
 
     try:
-        while True:
-            data = await reader.read(1024)
-            if not data:
+        while not reader.at_eof():
+            # StreamReader does the framing, so lines split across reads stay whole
+            line_bytes = await read_line(reader)
+            if line_bytes is None:
+                await send_msg(user, "Message too long")
+                continue
+            if not line_bytes:
                 break
-            for line in data.decode(errors='ignore').splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                if line.startswith("/"):
-                    await handle_command(user, line)
-                    continue
-                # public message
-                if len(line) > 400:
-                    await send_msg(writer, "Message too long")
-                    continue
-                ts = datetime.datetime.now().strftime("%H:%M")
-                msg = f"[{ts}] <{user.nick}> {line}"
-                await chat_server.broadcast(msg, skip_nick=user.nick)
-
-                conn = sqlite3.connect(DB_PATH)
-                c = conn.cursor()
-                c.execute("INSERT INTO messages (from_nick, message) VALUES (?,?)",
-                          (user.nick, line))
-                conn.commit()
-                conn.close()
+            line = line_bytes.decode('utf-8', 'ignore').strip()
+            if line:
+                await dispatch(user, line)
 
     except Exception as e:
         print(f"Error {addr}: {e}")
     finally:
-        nick_lower = user.nick.lower()
-        if nick_lower in chat_server.users:
-            del chat_server.users[nick_lower]
+        if user.nick_lower in chat_server.users:
+            del chat_server.users[user.nick_lower]
         await chat_server.broadcast(f"* {user.nick} left")
         writer.close()
         await writer.wait_closed()
@@ -301,12 +455,18 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
 
 async def main():
     init_db()
+    chat_server.start()
     server = await asyncio.start_server(handle_client, HOST, PORT)
     print(f"Listening on {server.sockets[0].getsockname()}")
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await chat_server.stop()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except KeyboardInterrupt: